@@ -8,31 +8,55 @@ import asyncio
 import aiohttp
 import logging
 import functools
+import time
+import weakref
 
 
 LOGGER = logging.getLogger(__package__)
 
+# the event loop runs timers up to one clock tick early, which is
+# about 15 ms on Windows
+_CLOCK_RESOLUTION = time.get_clock_info("monotonic").resolution
+# selectors wait in steps of milliseconds, neither is finer timing kept
+# nor can a sleep shorter than one clock tick be told apart from none
+_MIN_SLEEP = max(0.001, _CLOCK_RESOLUTION)
+
+# seconds worth of data fed before the limits are checked again
+_CHECK_INTERVAL = 0.02
+
 
 class Throttle:
     """Throttle for IO operations
 
-    As soon as an IO action is registered using :meth:`add_io`,
-    :meth:`time_left` returns the seconds to wail until
-    ``[byte count] / [time passed] = [rate limit]``.
-    After that, :meth:`reset_io` has to be called to measure the new rate.
+    The throttle is a token bucket, refilled with ``limit`` bytes per second
+    and holding at most one second's worth of bytes. Each IO action
+    registered using :meth:`add_io` takes its bytes from the bucket,
+    :meth:`time_left` returns the seconds to wait until the bucket is
+    no longer in debt.
+    :meth:`reset_io` starts a new measurement for :meth:`current_rate`.
+
+    To limit both directions of a connection independently,
+    use one throttle for reading and another one for writing.
 
     :param int limit: the limit in bytes to read/write per second
     :raises: :class:`ValueError`: invalid rate given
     """
 
+    __slots__ = (
+        "_limit", "_inv_limit", "_io", "_tokens",
+        "_loop", "_reset_time", "_last_refill", "_readers")
+
     def __init__(self, limit, loop=None):
+        # the readers using this throttle, rechecked on limit changes
+        self._readers = weakref.WeakSet()
         self._limit = 0
         self.limit = limit
         self._io = 0
+        self._tokens = 0
         if loop is None:
             loop = asyncio.get_event_loop()
         self._loop = loop
-        self._reset_time = loop.time()
+        self._reset_time = self._last_refill = loop.time()
 
     @property
     def limit(self):
@@ -45,51 +69,71 @@ class Throttle:
     @limit.setter
     def limit(self, value):
         """
+        All :class:`ThrottledStreamReader` using this throttle
+        recheck their limits at the new rate.
+
         :param value: the limit in bytes to read/write per second
         :raises: :class:`ValueError` invalid rate given
         """
         if value <= 0:
             raise ValueError("rate_limit has to be greater than 0")
+        if self._limit:
+            # the time until now is refilled at the old limit
+            self._refill()
         self._limit = value
-
-    def time_left(self):
+        self._inv_limit = 1 / value
+        for reader in list(self._readers):
+            reader._check_limits()
+
+    def _refill(self, now=None):
+        """adds the tokens earned since the last refill to the bucket"""
+        if now is None:
+            now = self._loop.time()
+        tokens = self._tokens + (now - self._last_refill) * self._limit
+        self._tokens = min(tokens, self._limit)
+        self._last_refill = now
+
+    def time_left(self, now=None):
         """returns the number of seconds left until the rate limit is reached
 
+        :param float now: the current loop time, if already known
         :returns: seconds left until the rate limit is reached
         :rtype: float
+
+        .. versionchanged:: 0.1.4
+           accepts the current loop time
         """
-        remaining = self._io / self._limit
-        LOGGER.debug("[throttle] time remaining: %.3f", remaining)
-        return remaining
+        self._refill(now)
+        return max(0.0, -self._tokens * self._inv_limit)
 
     def add_io(self, byte_count):
         """registers a number of bytes read/written
 
         :param int byte_count: number of bytes to add to the current rate
         """
+        self._refill()
+        self._tokens -= byte_count
         self._io += byte_count
-        LOGGER.debug(
-            "[throttle] added bytes: %d, now: %d",
-            byte_count, self._io)
 
     def reset_io(self):
-        """resets the registered IO actions"""
+        """resets the IO actions registered for :meth:`current_rate`"""
         self._io = 0
         self._reset_time = self._loop.time()
-        LOGGER.debug("[throttle] reset IO")
 
-    @asyncio.coroutine
-    def wait_remaining(self):
+    async def wait_remaining(self):
         """waits until the rate limit is reached"""
         time_left = self.time_left()
+        if time_left < _MIN_SLEEP:
+            # yield to the loop without arming a timer
+            time_left = 0
         LOGGER.debug("[throttle] sleeping for %.3f seconds", time_left)
-        yield from asyncio.sleep(time_left)
+        await asyncio.sleep(time_left)
 
     def current_rate(self):
         """returns the current rate, measured since :meth:`reset_io`
 
         In case the time since the last reset is too short,
-        this returns ``-1``.
+        this returns ``0``.
 
         :returns: the current rate in bytes per second
         :rtype: float
@@ -100,7 +144,7 @@ class Throttle:
         duration = now - self._reset_time
 
         if duration <= 0:
-            raise RuntimeError("unable to measure rate, duraction <= 0")
+            return 0
 
         rate = self._io / duration
         LOGGER.debug("[throttle] measured current rate: %.3f B/s", rate)
@@ -112,8 +156,13 @@ class Throttle:
         :returns: ``True`` if the current rate is equal or below the limit rate
         :rtype: bool
         """
-        current = self.current_rate()
-        within_limit = current < self._limit
+        duration = self._loop.time() - self._reset_time
+        if self._io <= 0 or duration <= 0:
+            # current_rate() is 0 then
+            within_limit = True
+        else:
+            # same as current_rate() <= limit, without dividing
+            within_limit = self._io <= self._limit * duration
         LOGGER.debug(
             "[throttle] %s rate", "within" if within_limit else "not within")
         return within_limit
@@ -134,31 +183,52 @@ class ThrottledStreamReader(aiohttp.StreamReader):
 
     :param aiohttp.parsers.StreamParser stream: the base stream
     :param int rate_limit: the rate limit in bytes per second
-    :param int buffer_limit: the internal buffer limit in bytes
+    :param int buffer_limit: the internal buffer limit in bytes,
+        reading is paused at twice this size and resumed once the
+        buffer is read down to it
     :param asyncio.BaseEventLoop loop: the asyncio event loop
     :param tuple args: arguments passed through to StreamReader
+    :param Throttle throttle: a throttle shared with other readers,
+        instead of a new one limited to ``rate_limit``
     :param dict kwargs: keyword arguments passed through to StreamReader
+
+    .. versionchanged:: 0.1.4
+       added the ``throttle`` parameter
     """
 
     def __init__(
             self, stream, rate_limit,
-            buffer_limit=2**16, loop=None, *args, **kwargs):
+            buffer_limit=2**16, loop=None, *args, throttle=None, **kwargs):
         super().__init__(loop=loop, *args, **kwargs)
 
-        self._loop = loop or asyncio.get_event_loop()
-        self._throttle = Throttle(rate_limit, self._loop)
+        if throttle is None:
+            # StreamReader has already resolved self._loop
+            throttle = Throttle(rate_limit, self._loop)
+        self._throttle = throttle
+        self._unchecked = 0
         self._stream = stream
         self._b_limit = buffer_limit * 2
+        # a full buffer is read down to this before resuming
+        self._b_resume = buffer_limit
         self._b_limit_reached = False
         self._check_handle = None
+        self._check_when = None
         self._throttling = True
 
+        # look up the transport once instead of on every pause/resume
+        try:
+            transport = stream.transport
+            self._pause_reading = transport.pause_reading
+            self._resume_reading = transport.resume_reading
+        except AttributeError:
+            transport = self._pause_reading = self._resume_reading = None
+        # Python 3.5.0 and third-party transports may lack is_closing()
+        self._is_closing = getattr(transport, "is_closing", None)
+
+        throttle._readers.add(self)
+
         # resume transport reading
-        if stream.paused:
-            try:
-                stream.transport.resume_reading()
-            except AttributeError:
-                pass
+        self._try_resume()
 
     def __del__(self):
         if self._check_handle is not None:
@@ -187,12 +257,16 @@ class ThrottledStreamReader(aiohttp.StreamReader):
     def limit_rate(self, limit):
         """Sets the rate limit of this response
 
+        If the throttle is shared, this sets the limit of all the
+        readers sharing it, and all of them recheck their limits
+
         :param limit: the limit in bytes to read/write per second
 
         .. versionadded:: 0.1.1
         """
-        self._throttle.limit = limit
         self._throttling = True
+        # rechecks all the readers, the debt is paid off at the new rate
+        self._throttle.limit = limit
 
     def unlimit_rate(self):
         """Unlimits the rate of this response
@@ -200,162 +274,177 @@ class ThrottledStreamReader(aiohttp.StreamReader):
         .. versionadded:: 0.1.1
         """
         self._throttling = False
-        if self._buffer_size < self._b_limit:
-            self._try_resume()
+        self._check_limits()
 
     def _try_pause(self):
         """Pauses the transport if not already paused"""
-        if self._stream.paused:
+        if self._stream.paused or self._pause_reading is None:
             return
         try:
-            if self._stream.transport.is_closing():
+            if self._is_closing is not None and self._is_closing():
                 LOGGER.debug("[reader] is closing, not pausing")
                 return
-            self._stream.transport.pause_reading()
-        except AttributeError:
-            pass
+            self._pause_reading()
         except RuntimeError as e:
             # This can occur because _SSLProtocolTransport does not
             # correctly pass through is_closing()
-            LOGGER.warn("[reader] RuntimeError: %s", e)
-            pass
+            LOGGER.warning("[reader] RuntimeError: %s", e)
         else:
             self._stream.paused = True
             LOGGER.debug("[reader] paused")
 
     def _try_resume(self):
-        """Resumed the transport if paused"""
-        if not self._stream.paused:
+        """Resumes the transport if paused and not closing"""
+        if not self._stream.paused or self._resume_reading is None:
             return
         try:
-            self._stream.transport.resume_reading()
-        except AttributeError:
-            pass
+            if self._is_closing is not None and self._is_closing():
+                LOGGER.debug("[reader] is closing, not resuming")
+                return
+            self._resume_reading()
+        except RuntimeError as e:
+            # the transport's own pause state went out of sync
+            LOGGER.warning("[reader] RuntimeError: %s", e)
         else:
             self._stream.paused = False
             LOGGER.debug("[reader] resumed")
 
     def feed_data(self, data, _=0):
         """Feeds data into the internal buffer"""
-        LOGGER.debug("[reader] got fed %d bytes", len(data))
         super().feed_data(data)
-        self._throttle.reset_io()
-        self._throttle.add_io(len(data))
-        self._check_limits()
+        if not self._throttling:
+            # only the buffer limit is watched
+            if self._stream.paused or self._buffer_size >= self._b_limit:
+                self._check_limits()
+            return
+
+        byte_count = len(data)
+        self._throttle.add_io(byte_count)
+
+        # the throttle keeps track of every byte, so small chunks
+        # may pass unchecked as long as the buffer isn't full,
+        # the limit is looked up as a shared throttle may change it
+        self._unchecked += byte_count
+        if (
+                self._unchecked >= self._throttle.limit * _CHECK_INTERVAL or
+                self._buffer_size >= self._b_limit):
+            self._unchecked = 0
+            self._check_limits()
 
     def _check_callback(self):
-        """Tries to resume the transport after the rate limit is reached"""
+        """Rechecks the limits when a scheduled resume is due"""
         self._check_handle = None
-        self._try_resume()
+        self._check_limits()
 
-    def _schedule_resume(self):
-        """resumes the transport as soon as the rate limit is reached"""
-        # resume as soon as the target rate is reached
+    def _cancel_check(self):
+        """Cancels a scheduled resume"""
         if self._check_handle is not None:
             self._check_handle.cancel()
+            self._check_handle = None
 
-        pause_time = self._throttle.time_left()
-        LOGGER.debug("[reader] resuming in %.3f seconds", pause_time)
-        self._check_handle = self._loop.call_later(
-            pause_time, self._check_callback)
-
-    @asyncio.coroutine
-    def _check_buffer_limit(self):
-        """Controls the size of the internal buffer"""
-        buf_size = self._buffer_size
-        if self._stream.paused:
-            try:
-                within_limit = self._throttle.within_limit()
-            except RuntimeError:
-                # not enough time has passed since feed_data()
-                yield from asyncio.sleep(.001)
-                yield from self._check_buffer_limit()
-                return
+    def _schedule_resume(self, pause_time=None, now=None):
+        """resumes the transport as soon as the rate limit is reached
 
-            resume = (
-                buf_size < self._b_limit and (
-                    not self._throttling or
-                    within_limit))
-
-            if resume:
-                LOGGER.debug("[reader] resuming throttling")
-                self._try_resume()
-                self._b_limit_reached = False
-            else:
-                self._schedule_resume()
-        else:
-            # read() only reduces buffer size,
-            # feed_data() pauses on full buffer,
-            # so this can only be reached on
-            # non-full buffer
-            assert buf_size <= self._b_limit
+        :param float pause_time: the already known :meth:`Throttle.time_left`
+        :param float now: the loop time ``pause_time`` was computed at
+        """
+        if now is None:
+            now = self._loop.time()
+        if pause_time is None:
+            pause_time = self._throttle.time_left(now)
+        when = now + pause_time + _CLOCK_RESOLUTION
 
-    def _check_limits(self):
-        """Controls rate and buffer size by pausing/resuming the transport"""
         if self._check_handle is not None:
+            if self._check_when < when + _MIN_SLEEP:
+                # the scheduled check comes first and reschedules
+                # if needed, cancelling would only leave it in the heap
+                return
             self._check_handle.cancel()
-            self._check_handle = None
 
-        buf_size = self._buffer_size
+        # resume as soon as the target rate is reached
+        LOGGER.debug("[reader] resuming in %.3f seconds", pause_time)
+        self._check_handle = self._loop.call_at(when, self._check_callback)
+        self._check_when = when
 
-        if not self._throttling:
-            # only watch the buffer limit
-            if (
-                    self._stream.paused and
-                    buf_size < self._b_limit):
-                LOGGER.debug("[reader] resuming unthrottling")
-                self._try_resume()
-            return
+    def _check_limits(self):
+        """Controls rate and buffer size by pausing/resuming the transport
 
-        self._try_pause()
+        Called after data was fed or read and when a scheduled resume
+        is due.
+        """
+        if self._eof:
+            # nothing more will be received, e.g. read(-1) draining
+            # the buffer after the response ended, so don't leave
+            # the connection paused when it goes back to the pool
+            self._cancel_check()
+            self._try_resume()
+            return
 
         # watch the buffer limit
-        if buf_size >= self._b_limit:
-            LOGGER.debug("[reader] byte limit reached, not resuming")
+        buf_size = self._buffer_size
+        if buf_size >= self._b_limit or (
+                self._b_limit_reached and buf_size > self._b_resume):
+            if __debug__:
+                LOGGER.debug("[reader] byte limit reached, not resuming")
+            self._cancel_check()
+            self._try_pause()
             self._b_limit_reached = True
             return
+        self._b_limit_reached = False
+
+        if self._throttling:
+            now = self._loop.time()
+            pause_time = self._throttle.time_left(now)
+        else:
+            pause_time = 0.0
+        if pause_time < _MIN_SLEEP:
+            # the data arrived slower than the rate limit,
+            # pausing would only be undone right away
+            self._cancel_check()
+            self._try_resume()
+            return
 
-        self._schedule_resume()
+        self._try_pause()
+        self._schedule_resume(pause_time, now)
 
-    @asyncio.coroutine
-    def read(self, byte_count=-1):
+    async def read(self, byte_count=-1):
         """Reads at most the requested number of bytes from the internal buffer
 
         :param int byte_count: the number of bytes to read
         :returns: the data
         :rtype: bytes
         """
-        LOGGER.debug("[reader] reading %d bytes", byte_count)
-        data = yield from super().read(byte_count)
-        yield from self._check_buffer_limit()
+        if __debug__:
+            LOGGER.debug("[reader] reading %d bytes", byte_count)
+        data = await super().read(byte_count)
+        self._check_limits()
         return data
 
-    @asyncio.coroutine
-    def readline(self):
+    async def readline(self):
         """Reads bytes from the internal buffer until ``\\n`` is found
 
         :returns: the data
         :rtype: bytes
         """
-        LOGGER.debug("[reader] reading line")
-        data = yield from super().readline()
-        yield from self._check_buffer_limit()
+        if __debug__:
+            LOGGER.debug("[reader] reading line")
+        data = await super().readline()
+        self._check_limits()
         return data
 
-    @asyncio.coroutine
-    def readany(self):
+    async def readany(self):
         """Reads the bytes next received from the internal buffer
 
         :returns: the data
         :rtype: bytes
         """
-        LOGGER.debug("[reader] reading anything")
-        data = yield from super().readany()
-        yield from self._check_buffer_limit()
+        if __debug__:
+            LOGGER.debug("[reader] reading anything")
+        data = await super().readany()
+        self._check_limits()
         return data
 
-    @asyncio.coroutine
-    def readexactly(self, byte_count):
+    async def readexactly(self, byte_count):
         """Reads the requested number of bytes from the internal buffer
 
         This raises :class:`asyncio.IncompleteReadError` if
@@ -365,21 +454,32 @@ class ThrottledStreamReader(aiohttp.StreamReader):
         :returns: the data
         :rtype: bytes
         """
-        LOGGER.debug("[reader] reading exactly %d bytes", byte_count)
-        data = yield from super().readexactly(byte_count)
-        yield from self._check_buffer_limit()
+        if __debug__:
+            LOGGER.debug("[reader] reading exactly %d bytes", byte_count)
+        data = await super().readexactly(byte_count)
+        self._check_limits()
         return data
 
 
-def limit_rate(limit):
+def limit_rate(limit, shared=False, loop=None):
     """Limits the rate of all subsequent aiohttp requests
 
     :param limit: the limit in bytes to read/write per second
+    :param bool shared: whether the requests share the limit,
+        instead of each one being limited on its own
+    :param asyncio.BaseEventLoop loop: the asyncio event loop
+        of the shared throttle
 
     .. versionadded:: 0.1.1
+
+    .. versionchanged:: 0.1.4
+       added the ``shared`` and ``loop`` parameters
     """
+    kwargs = {}
+    if shared:
+        kwargs["throttle"] = Throttle(limit, loop)
     partial = functools.partial(
-        ThrottledStreamReader, rate_limit=limit)
+        ThrottledStreamReader, rate_limit=limit, **kwargs)
     aiohttp.client_reqrep.ClientResponse.flow_control_class = partial
 
 
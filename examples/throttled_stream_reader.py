@@ -6,9 +6,8 @@ import aiohttp
 import aiothrottle
 
 
-@asyncio.coroutine
-def load_file(url, loop):
-    response = yield from aiohttp.request("GET", url, loop=loop)
+async def load_file(url, loop):
+    response = await aiohttp.request("GET", url, loop=loop)
     size = int(response.headers.get("Content-Length", "0"))
 
     start_time = loop.time()
@@ -21,7 +20,7 @@ def load_file(url, loop):
         prev_print_loaded = 0
         while read_next:
             # read 1 MB chunks
-            chunk = yield from response.content.read(2**20)
+            chunk = await response.content.read(2**20)
             file.write(chunk)
 
             chunk_len = len(chunk)
@@ -1,28 +1,34 @@
 import asyncio
+import contextlib
 from unittest import TestCase
 from unittest.mock import Mock, patch
-import sys
 import aiothrottle
 
-PY34 = sys.version_info >= (3, 4)
 
-
-@asyncio.coroutine
-def sleep_mock(*_):
+async def sleep_mock(*_):
     pass
 
 
 class TestThrottle(TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        # the code under test has to use the loop it is given
+        asyncio.set_event_loop(None)
+
     def setUp(self):
         self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(None)
 
     def _make_one(self):
         return aiothrottle.Throttle(limit=10, loop=self.loop)
 
+    @contextlib.contextmanager
     def _set_time(self, time):
-        return patch.object(self.loop, "time", return_value=time)
+        self.loop.time = lambda: time
+        try:
+            yield
+        finally:
+            del self.loop.time
 
     def test_parameters(self):
         with self._set_time(111):
@@ -32,9 +38,16 @@ class TestThrottle(TestCase):
             t = self._make_one()
         self.assertEqual(t._limit, 10)
         self.assertEqual(t.limit, 10)
+        self.assertEqual(t._inv_limit, 1/10)
         self.assertEqual(t._io, 0)
+        self.assertEqual(t._tokens, 0)
         self.assertIs(t._loop, self.loop)
         self.assertEqual(t._reset_time, 111)
+        self.assertEqual(t._last_refill, 111)
+
+    def test_slots(self):
+        t = self._make_one()
+        self.assertRaises(AttributeError, setattr, t, "unknown", 1)
 
     def test_invalid_limit(self):
         self.assertRaises(
@@ -48,9 +61,55 @@ class TestThrottle(TestCase):
             ValueError, setattr, t, "limit", -10)
 
     def test_time_left(self):
-        t = self._make_one()
-        t.add_io(2)
-        self.assertEqual(t.time_left(), 2/10)
+        with self._set_time(111):
+            t = self._make_one()
+            t.add_io(2)
+            self.assertEqual(t.time_left(), 2/10)
+        with self._set_time(111.1):
+            self.assertAlmostEqual(t.time_left(), 1/10)
+        with self._set_time(112):
+            self.assertEqual(t.time_left(), 0)
+
+    def test_time_left_now(self):
+        with self._set_time(111):
+            t = self._make_one()
+            t.add_io(2)
+        with self._set_time(200):
+            # refilled up to 111.1, not 200
+            self.assertAlmostEqual(t.time_left(111.1), 1/10)
+
+    def test_limit_change_refill(self):
+        with self._set_time(111):
+            t = aiothrottle.Throttle(1000, loop=self.loop)
+            t.add_io(1000)
+        with self._set_time(111.5):
+            t.limit = 10
+            # 500 bytes left, paid off at 10 B/s
+            self.assertAlmostEqual(t.time_left(), 50)
+
+        with self._set_time(111):
+            t = self._make_one()
+            t.add_io(100)
+        with self._set_time(112):
+            t.limit = 1000
+            # 90 bytes left, paid off at 1000 B/s
+            self.assertAlmostEqual(t.time_left(), 0.09)
+
+    def test_time_left_accumulating(self):
+        with self._set_time(111):
+            t = self._make_one()
+            t.add_io(2)
+        with self._set_time(111.1):
+            t.add_io(2)
+            self.assertAlmostEqual(t.time_left(), 3/10)
+
+    def test_refill_capacity(self):
+        with self._set_time(111):
+            t = self._make_one()
+        with self._set_time(200):
+            t.add_io(15)
+            self.assertEqual(t._tokens, -5)
+            self.assertEqual(t.time_left(), 5/10)
 
     def test_add_io(self):
         t = self._make_one()
@@ -58,23 +117,36 @@ class TestThrottle(TestCase):
         self.assertEqual(t._io, 2)
 
     def test_reset_io(self):
-        t = self._make_one()
-        t.add_io(2)
-        t.reset_io()
-        self.assertEqual(t._io, 0)
+        with self._set_time(111):
+            t = self._make_one()
+            t.add_io(2)
+            t.reset_io()
+            self.assertEqual(t._io, 0)
+            # the bucket keeps its debt
+            self.assertEqual(t.time_left(), 2/10)
 
     @patch("asyncio.sleep", Mock(wraps=sleep_mock))
     def test_wait_remaining(self):
-        t = self._make_one()
-        t.add_io(2)
-        self.loop.run_until_complete(t.wait_remaining())
+        with self._set_time(111):
+            t = self._make_one()
+            t.add_io(2)
+            self.loop.run_until_complete(t.wait_remaining())
         asyncio.sleep.assert_called_with(2/10)
 
+    @patch("asyncio.sleep", Mock(wraps=sleep_mock))
+    def test_wait_remaining_short(self):
+        with self._set_time(111):
+            t = self._make_one()
+            t.add_io(2)
+        with self._set_time(111.2 - 0.0001):
+            self.loop.run_until_complete(t.wait_remaining())
+        asyncio.sleep.assert_called_with(0)
+
     def test_current_rate(self):
         with self._set_time(111):
             t = self._make_one()
             t.add_io(2)
-            self.assertRaises(RuntimeError, t.current_rate)
+            self.assertEqual(t.current_rate(), 0)
 
         with self._set_time(116):
             self.assertEqual(t.current_rate(), 2/5)
@@ -84,6 +156,18 @@ class TestThrottle(TestCase):
     def test_within_limit(self):
         with self._set_time(111):
             t = self._make_one()
+            self.assertTrue(t.within_limit())
+            t.add_io(2)
+            # no time passed, like current_rate() returning 0
+            self.assertEqual(t.current_rate(), 0)
+            self.assertTrue(t.within_limit())
+        with self._set_time(111.25):
+            # 8 B/s
+            self.assertTrue(t.within_limit())
+        with self._set_time(111.1):
+            # 20 B/s
+            self.assertFalse(t.within_limit())
+            t.reset_io()
         t.add_io(2)
         with self._set_time(116):
             self.assertTrue(t.within_limit())
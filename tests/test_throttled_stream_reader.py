@@ -1,4 +1,5 @@
 import asyncio
+import contextlib
 import functools
 from unittest import TestCase
 from unittest.mock import Mock, patch
@@ -7,20 +8,22 @@ from aiohttp.client_reqrep import ClientResponse
 import aiothrottle
 
 
-@asyncio.coroutine
-def sleep_mock(*_):
-    pass
+class TestThrottledStreamReader(TestCase):
 
+    # more than the rate limit, less than the buffer limit
+    _PAYLOAD = b"data" * 3
 
-class TestThrottledStreamReader(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        # the code under test has to use the loop it is given
+        asyncio.set_event_loop(None)
 
     def setUp(self):
         self.stream = Mock()
         self.stream.paused = True
-        self.stream.transport.is_closing.side_effect = [False]
+        self.stream.transport.is_closing.return_value = False
         self.transp = self.stream.transport
         self.loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(None)
 
     def tearDown(self):
         self.loop.close()
@@ -30,8 +33,13 @@ class TestThrottledStreamReader(TestCase):
             self.stream, rate_limit=10, buffer_limit=10, loop=self.loop)
         return r
 
+    @contextlib.contextmanager
     def _set_time(self, time):
-        return patch.object(self.loop, "time", return_value=time)
+        self.loop.time = lambda: time
+        try:
+            yield
+        finally:
+            del self.loop.time
 
     def test_parameters(self):
         with patch("asyncio.get_event_loop", return_value=self.loop):
@@ -45,27 +53,73 @@ class TestThrottledStreamReader(TestCase):
         self.assertEqual(r._throttle.limit, 10)
         self.assertIs(r._stream, self.stream)
         self.assertEqual(r._b_limit, 2 * 10)
+        self.assertEqual(r._b_resume, 10)
+        self.assertEqual(r._unchecked, 0)
         self.assertFalse(r._b_limit_reached)
         self.assertIsNone(r._check_handle)
+        self.assertIsNone(r._check_when)
         self.assertTrue(r.throttling)
         self.assertTrue(self.transp.resume_reading.called)
+        self.assertFalse(self.stream.paused)
 
     def test_attribute_error(self):
         with patch.object(
                 self, "stream", Mock(spec=["paused"])):
-            # test catching AttributeError on stream.transport
+            # test a stream without a pausable transport
             r = self._make_one()
             self.stream.paused = False
             r._try_pause()
             self.stream.paused = True
             r._try_resume()
 
+    def test_no_is_closing(self):
+        # test a transport without is_closing()
+        self.stream.transport = Mock(
+            spec=["pause_reading", "resume_reading"])
+        with self._set_time(111):
+            r = self._make_one()
+            self.assertTrue(self.stream.transport.resume_reading.called)
+            self.assertFalse(self.stream.paused)
+            r.feed_data(self._PAYLOAD)
+        self.assertTrue(self.stream.transport.pause_reading.called)
+        self.assertTrue(self.stream.paused)
+
     def test_limit_rate(self):
         r = self._make_one()
-        r.limit_rate(20)
-        self.assertEqual(r._throttle.limit, 20)
+        r.limit_rate(200)
+        self.assertEqual(r._throttle.limit, 200)
         self.assertTrue(r.throttling)
 
+    def test_limit_rate_rescheduling(self):
+        r = self._make_one_nonfull_buffer()
+        handle = r._check_handle
+        with self._set_time(111):
+            r.limit_rate(20)
+        # 12 bytes of debt at 20 B/s
+        self.assertTrue(handle._cancelled)
+        self.assertAlmostEqual(
+            r._check_handle._when,
+            111 + 12 / 20 + aiothrottle.throttle._CLOCK_RESOLUTION)
+        self.assertTrue(self.stream.paused)
+
+    def test_limit_rate_keeping_debt(self):
+        r = self._make_one_nonfull_buffer()
+        with self._set_time(111.1):
+            r.limit_rate(100)
+        # 11 bytes of debt left from 10 B/s, paid off at 100 B/s
+        self.assertAlmostEqual(
+            r._check_handle._when,
+            111.1 + 11 / 100 + aiothrottle.throttle._CLOCK_RESOLUTION)
+        self.assertTrue(self.stream.paused)
+
+    def test_limit_rate_resuming(self):
+        r = self._make_one_nonfull_buffer()
+        # the debt is paid off at 10 B/s by 112.2
+        with self._set_time(112.3):
+            r.limit_rate(10000)
+        self.assertIsNone(r._check_handle)
+        self.assertFalse(self.stream.paused)
+
     def test_unlimit_rate(self):
         r = self._make_one()
         r.unlimit_rate()
@@ -76,9 +130,28 @@ class TestThrottledStreamReader(TestCase):
         aiothrottle.limit_rate(10)
         klass = ClientResponse.flow_control_class
         self.assertIsInstance(klass, functools.partial)
-        r = klass(self.stream, loop=self.loop)
-        self.assertIsInstance(r, aiothrottle.ThrottledStreamReader)
-        self.assertEqual(r._throttle.limit, 10)
+        self.assertIs(klass.func, aiothrottle.ThrottledStreamReader)
+        self.assertEqual(klass.keywords, {"rate_limit": 10})
+
+    def test_global_limit_rate_shared(self):
+        aiothrottle.limit_rate(10, shared=True, loop=self.loop)
+        klass = ClientResponse.flow_control_class
+        r1 = klass(self.stream, loop=self.loop)
+        r2 = klass(self.stream, loop=self.loop)
+        self.assertIs(r1._throttle, r2._throttle)
+        self.assertEqual(r1._throttle.limit, 10)
+
+    def test_shared_throttle(self):
+        with self._set_time(111):
+            t = aiothrottle.Throttle(10, loop=self.loop)
+            r1 = aiothrottle.ThrottledStreamReader(
+                self.stream, rate_limit=10, loop=self.loop, throttle=t)
+            r2 = aiothrottle.ThrottledStreamReader(
+                self.stream, rate_limit=10, loop=self.loop, throttle=t)
+            r1.feed_data(b"data")
+            self.assertAlmostEqual(t.time_left(), 4/10)
+            r2.feed_data(b"data")
+            self.assertAlmostEqual(t.time_left(), 8/10)
 
     def test_global_unlimit_rate(self):
         aiothrottle.limit_rate(10)
@@ -114,65 +187,125 @@ class TestThrottledStreamReader(TestCase):
         self.assertFalse(self.transp.pause_reading.called)
         self.assertTrue(self.transp.resume_reading.called)
 
-    @patch("asyncio.sleep", Mock(wraps=sleep_mock))
+    def test_closing(self):
+        r = self._make_one()
+        self.transp.reset_mock()
+        self.transp.is_closing.return_value = True
+
+        self.stream.paused = False
+        r._try_pause()
+        self.assertFalse(self.transp.pause_reading.called)
+        self.assertFalse(self.stream.paused)
+
+        self.stream.paused = True
+        r._try_resume()
+        self.assertFalse(self.transp.resume_reading.called)
+        self.assertTrue(self.stream.paused)
+
+    def test_runtime_error(self):
+        r = self._make_one()
+        self.transp.pause_reading.side_effect = RuntimeError
+        self.transp.resume_reading.side_effect = RuntimeError
+
+        self.stream.paused = False
+        r._try_pause()
+        self.assertFalse(self.stream.paused)
+
+        self.stream.paused = True
+        r._try_resume()
+        self.assertTrue(self.stream.paused)
+
     def test_read(self):
         r = self._make_one()
         r.feed_data(b'da')
         res = self.loop.run_until_complete(r.read(1))
         self.assertEqual(res, b'd')
+        # the rest of the chunk stays buffered
+        res = self.loop.run_until_complete(r.read(1))
+        self.assertEqual(res, b'a')
 
-    @patch("asyncio.sleep", Mock(wraps=sleep_mock))
     def test_readline(self):
         r = self._make_one()
         r.feed_data(b'data\n')
         res = self.loop.run_until_complete(r.readline())
         self.assertEqual(res, b'data\n')
 
-    @patch("asyncio.sleep", Mock(wraps=sleep_mock))
     def test_readany(self):
         r = self._make_one()
         r.feed_data(b'data')
         res = self.loop.run_until_complete(r.readany())
         self.assertEqual(res, b'data')
 
-    @patch("asyncio.sleep", Mock(wraps=sleep_mock))
     def test_readexactly(self):
         r = self._make_one()
         r.feed_data(b'datadata')
         res = self.loop.run_until_complete(r.readexactly(2))
         self.assertEqual(res, b'da')
+        res = self.loop.run_until_complete(r.readexactly(6))
+        self.assertEqual(res, b'tadata')
+
+    def test_read_eof(self):
+        with self._set_time(111):
+            r = self._make_one()
+            r.feed_data(b'data')
+            r.feed_data(b'data')
+        # paused for the debt of the last chunk
+        self.assertTrue(self.stream.paused)
+        r.feed_eof()
+        self.transp.reset_mock()
+        with self._set_time(111), patch.object(
+                aiothrottle.Throttle, "time_left",
+                return_value=1.0) as time_left:
+            res = self.loop.run_until_complete(r.read())
+        self.assertEqual(res, b'datadata')
+        # nothing more to throttle, the transport is resumed right away
+        self.assertFalse(time_left.called)
+        self.assertTrue(self.transp.resume_reading.called)
+        self.assertFalse(self.transp.pause_reading.called)
+        self.assertFalse(self.stream.paused)
+        self.assertIsNone(r._check_handle)
+
+    def test_eof_check_callback(self):
+        r = self._make_one_nonfull_buffer()
+        self.assertTrue(self.stream.paused)
+        self.assertIsNotNone(r._check_handle)
+        r.feed_eof()
+        with self._set_time(112.2):
+            r._check_callback()
+        self.assertTrue(self.transp.resume_reading.called)
+        self.assertFalse(self.stream.paused)
+        self.assertIsNone(r._check_handle)
 
     def _make_one_nonfull_buffer(self):
         with self._set_time(111):
             r = self._make_one()
             self.transp.reset_mock()
-            r.feed_data(b"data" * 3)
+            r.feed_data(self._PAYLOAD)
         return r
 
     def _make_one_full_buffer(self):
         r = self._make_one_nonfull_buffer()
         with self._set_time(111):
-            r.feed_data(b"data" * 3)
+            r.feed_data(self._PAYLOAD)
         return r
 
-    def test_recheck_on_error(self):
-        current_time = 111
-
-        def time_mock():
-            return current_time
-
-        @asyncio.coroutine
-        def timing_sleep_mock(delay, *_):
-            # simulate the passing of time
-            nonlocal current_time
-            current_time += delay
+    def test_read_in_debt(self):
+        with self._set_time(111):
+            r = self._make_one()
+            r.feed_data(b"datadata")
+        self.transp.reset_mock()
 
-        with patch("asyncio.sleep", Mock(wraps=timing_sleep_mock)):
+        with self._set_time(111.2):
+            self.loop.run_until_complete(r.read(4))
+        self.assertTrue(self.stream.paused)
+        self.assertAlmostEqual(
+            r._check_when,
+            111 + 8 / 10 + aiothrottle.throttle._CLOCK_RESOLUTION)
 
-            with patch.object(self.loop, "time", time_mock):
-                r = self._make_one()
-                r.feed_data(b"data")
-                self.loop.run_until_complete(r.read(4))
+        with self._set_time(111.9):
+            self.loop.run_until_complete(r.read(4))
+        self.assertFalse(self.stream.paused)
+        self.assertTrue(self.transp.resume_reading.called)
 
     def test_nonfull_buffer(self):
         r = self._make_one_nonfull_buffer()
@@ -185,12 +318,149 @@ class TestThrottledStreamReader(TestCase):
     def test_scheduling_resume(self):
         r = self._make_one_nonfull_buffer()
         self.assertIsNotNone(r._check_handle)
-        self.assertEqual(r._check_handle._when, 111 + 12 / 10)
+        self.assertEqual(
+            r._check_handle._when,
+            111 + 12 / 10 + aiothrottle.throttle._CLOCK_RESOLUTION)
         mock_handle = Mock()
         r._check_handle = mock_handle
+        r._check_when = float("inf")
         r._schedule_resume()
         self.assertTrue(mock_handle.cancel.called)
 
+    def test_nonpausing_within_limit(self):
+        r = self._make_one()
+        self.stream.paused = False
+        self.transp.reset_mock()
+        with patch.object(
+                aiothrottle.Throttle, "time_left", return_value=0):
+            r.feed_data(b"data")
+        self.assertFalse(self.transp.pause_reading.called)
+        self.assertFalse(self.stream.paused)
+        self.assertIsNone(r._check_handle)
+
+    def test_scheduling_resume_coalescing(self):
+        r = self._make_one_nonfull_buffer()
+        handle = r._check_handle
+        with self._set_time(111):
+            r._check_limits()
+            r.feed_data(b"d")
+        self.assertIs(r._check_handle, handle)
+        self.assertFalse(handle._cancelled)
+
+    def test_scheduling_resume_earlier(self):
+        r = self._make_one_nonfull_buffer()
+        handle = r._check_handle
+        with self._set_time(111):
+            r.limit_rate(20)
+        self.assertIsNot(r._check_handle, handle)
+        self.assertTrue(handle._cancelled)
+        # 12 bytes of debt at 20 B/s instead of 10 B/s
+        self.assertAlmostEqual(
+            r._check_when,
+            111 + 12 / 20 + aiothrottle.throttle._CLOCK_RESOLUTION)
+        self.assertTrue(self.stream.paused)
+
+    def test_scheduling_resume_accumulating(self):
+        r = self._make_one_nonfull_buffer()
+        with self._set_time(111.5):
+            r.feed_data(b"data")
+        # the first check is kept, 1.2s debt of the first 12 bytes
+        self.assertAlmostEqual(
+            r._check_handle._when,
+            111 + 1.2 + aiothrottle.throttle._CLOCK_RESOLUTION)
+        self.assertEqual(r._throttle._io, 16)
+        with self._set_time(112.2):
+            r._check_callback()
+        # 0.4s debt of the latest 4 bytes left
+        self.assertAlmostEqual(
+            r._check_handle._when,
+            112.2 + 0.4 + aiothrottle.throttle._CLOCK_RESOLUTION)
+        self.assertTrue(self.stream.paused)
+
+    def test_batched_check(self):
+        r = aiothrottle.ThrottledStreamReader(
+            self.stream, rate_limit=1000, buffer_limit=20, loop=self.loop)
+        self.transp.reset_mock()
+
+        with self._set_time(111):
+            r.feed_data(self._PAYLOAD)
+            self.assertFalse(self.transp.pause_reading.called)
+            self.assertIsNone(r._check_handle)
+            self.assertEqual(r._unchecked, 12)
+
+            r.feed_data(self._PAYLOAD)
+            self.assertTrue(self.transp.pause_reading.called)
+            self.assertIsNotNone(r._check_handle)
+            self.assertEqual(r._unchecked, 0)
+
+    def test_batched_check_shared_throttle(self):
+        with self._set_time(111):
+            t = aiothrottle.Throttle(10, loop=self.loop)
+            r = aiothrottle.ThrottledStreamReader(
+                self.stream, rate_limit=10**7, buffer_limit=20,
+                loop=self.loop, throttle=t)
+            self.transp.reset_mock()
+            # checked at 10 B/s, not at rate_limit
+            r.feed_data(b"data")
+            self.assertTrue(self.transp.pause_reading.called)
+            self.assertEqual(r._unchecked, 0)
+
+    def test_batched_check_limit_rate_shared(self):
+        with self._set_time(111):
+            t = aiothrottle.Throttle(1000, loop=self.loop)
+            r1 = aiothrottle.ThrottledStreamReader(
+                self.stream, rate_limit=1000, buffer_limit=20,
+                loop=self.loop, throttle=t)
+            r2 = aiothrottle.ThrottledStreamReader(
+                self.stream, rate_limit=1000, buffer_limit=20,
+                loop=self.loop, throttle=t)
+            r1.limit_rate(10)
+            self.transp.reset_mock()
+            r2.feed_data(b"data")
+            self.assertTrue(self.transp.pause_reading.called)
+            self.assertEqual(r2._unchecked, 0)
+
+    def test_limit_rate_shared_rescheduling(self):
+        stream2 = Mock()
+        stream2.paused = True
+        stream2.transport.is_closing.return_value = False
+        with self._set_time(111):
+            t = aiothrottle.Throttle(10, loop=self.loop)
+            r1 = aiothrottle.ThrottledStreamReader(
+                self.stream, rate_limit=10, loop=self.loop, throttle=t)
+            r2 = aiothrottle.ThrottledStreamReader(
+                stream2, rate_limit=10, loop=self.loop, throttle=t)
+            r2.feed_data(bytes(100))
+            self.assertAlmostEqual(
+                r2._check_when,
+                111 + 10 + aiothrottle.throttle._CLOCK_RESOLUTION)
+
+            r1.limit_rate(10000)
+            # 100 bytes of debt at 10000 B/s
+            self.assertAlmostEqual(
+                r2._check_when,
+                111 + 0.01 + aiothrottle.throttle._CLOCK_RESOLUTION)
+            self.assertTrue(stream2.paused)
+
+    def test_throttle_limit_resuming(self):
+        with self._set_time(111):
+            t = aiothrottle.Throttle(10, loop=self.loop)
+            r = aiothrottle.ThrottledStreamReader(
+                self.stream, rate_limit=10, loop=self.loop, throttle=t)
+            r.feed_data(self._PAYLOAD)
+            self.assertTrue(self.stream.paused)
+        with self._set_time(112.3):
+            # set on the throttle itself, not through the reader
+            t.limit = 10000
+        self.assertIsNone(r._check_handle)
+        self.assertFalse(self.stream.paused)
+
+    def test_batched_check_full_buffer(self):
+        r = aiothrottle.ThrottledStreamReader(
+            self.stream, rate_limit=1000, buffer_limit=2, loop=self.loop)
+        r.feed_data(b"data")
+        self.assertTrue(r._b_limit_reached)
+
     def test_nonscheduling_resume(self):
         r = self._make_one_full_buffer()
         self.assertIsNone(r._check_handle)
@@ -201,6 +471,12 @@ class TestThrottledStreamReader(TestCase):
         self.assertIsNone(r._check_handle)
         self.assertFalse(self.stream.paused)
 
+    def test_check_callback_full_buffer(self):
+        r = self._make_one_full_buffer()
+        r._check_callback()
+        self.assertIsNone(r._check_handle)
+        self.assertTrue(self.stream.paused)
+
     def test_callback_cancel(self):
         r = self._make_one()
         handle = Mock()
@@ -244,6 +520,19 @@ class TestThrottledStreamReader(TestCase):
             self.loop.run_until_complete(r.read(20))
             self.assertFalse(self.stream.paused)
 
+    def test_nonthrottling_full_buffer_resuming_read(self):
+        r = self._make_one_full_buffer()
+        r.unlimit_rate()
+
+        with self._set_time(112):
+            self.loop.run_until_complete(r.read(8))
+            # below the limit, but not yet read down to half of it
+            self.assertTrue(self.stream.paused)
+            self.assertTrue(r._b_limit_reached)
+            self.loop.run_until_complete(r.read(6))
+            self.assertFalse(self.stream.paused)
+            self.assertFalse(r._b_limit_reached)
+
     def test_nonthrottling_nonfull_buffer_nonpausing_feed(self):
         r = self._make_one_nonfull_buffer()
         r.unlimit_rate()
@@ -269,3 +558,19 @@ class TestThrottledStreamReader(TestCase):
         r._try_pause()
         r.feed_data(b"data")
         self.assertTrue(self.stream.paused)
+
+    def test_nonthrottling_filling_buffer_pausing_feed(self):
+        r = self._make_one_nonfull_buffer()
+        r.unlimit_rate()
+        self.assertFalse(self.stream.paused)
+        r.feed_data(self._PAYLOAD)
+        self.assertTrue(self.stream.paused)
+        self.assertTrue(r._b_limit_reached)
+
+    def test_nonthrottling_feed_not_counted(self):
+        r = self._make_one_nonfull_buffer()
+        r.unlimit_rate()
+        with patch.object(aiothrottle.Throttle, "add_io") as add_io_mock:
+            r.feed_data(b"data")
+            add_io_mock.assert_not_called()
+        self.assertFalse(self.stream.paused)